@@ -1,260 +1,1347 @@
-"""
-    FastQC Pipeline | RPINerd, 12/09/24
-
-    FastQC_pipe.py will take an input of run files and analyze them with the fastqc tool in a quasi-parallel mode.
-    Input format is expected to be a list with the just the read file IDs:
-
-    Exp001_S1
-    Exp001_S2
-    Exp001_S3
-"""
-
-import argparse
-import logging
-import os
-import shutil
-import subprocess
-from pathlib import Path
-
-
-def arg_parser() -> argparse.Namespace:
-    """Parse command line arguments"""
-    parser = argparse.ArgumentParser()
-
-    # TODO allow inferring of reads by just providing a target folder
-    input_type = parser.add_argument_group()
-    input_type.add_argument(
-        "-d",
-        "--dir",
-        help="Directory where all fastq files are stored",
-        required=True,
-    )
-    input_type.add_argument(
-        "-f",
-        "--file",
-        help="Your input *.tsv/*.csv with list of fastq files",
-        required=True,
-    )
-
-    parser.add_argument(
-        "-t",
-        "--threads",
-        help="Number of simultaneous threads to run. By default it will use 1 thread per sample, \
-            or all available threads. Whichever is lower.",
-        required=False,
-        default=0,
-        type=int,
-    )
-    parser.add_argument(
-        "-m",
-        "--merge",
-        help="If desired, specify a location to save the fastq files after lane merge",
-        required=False,
-        default="",
-    )
-    parser.add_argument(
-        "-c",
-        "--clean",
-        help="After run, clean up the merge files from the disk",
-        required=False,
-        action="store_true",
-    )
-    parser.add_argument(
-        "-r",
-        "--reads",
-        help="Choose whether to limit QC to only R1 or R2. By defaut QC is run on both.",
-        required=False,
-        choices=[1, 2],
-        default=3,
-    )
-    parser.add_argument(
-        "-v",
-        "--verbose",
-        help="Outputs a lot more information for debugging and saves log",
-        required=False,
-        action="store_true",
-    )
-
-    return parser.parse_args()
-
-
-def setup_logging(verbose: bool) -> None:
-    """
-    Setup logging for the script
-
-    Args:
-        verbose (bool): If True, log all the things
-
-    Returns:
-        None
-    """
-    if verbose:
-        logging.basicConfig(
-            filename="fastqc_pipe.log",
-            filemode="a",
-            format="%(asctime)s - %(levelname)s - %(message)s",
-            encoding="utf-8",
-            datefmt="%H:%M:%S",
-            level=logging.DEBUG,
-        )
-    else:
-        logging.basicConfig(
-            format="%(asctime)s - %(message)s",
-            encoding="utf-8",
-            datefmt="%M:%S",
-            level=logging.INFO,
-        )
-
-
-def collect_reads(rootpath: str, readset: str, read_number: str) -> list:
-    """
-    Sub to hunt down red oct.. I mean all the individual lane files for each readset
-
-    Args:
-        rootpath (str): Root directory to search for files
-        readset (str): Sample ID to search for
-        read_number (str): Read number to search for
-
-    Returns:
-        matches (list): List of all files found matching the readset and read_number
-    """
-    matches = []
-    read_match = f"{readset}_L00[1-4]_R{read_number}*.fastq*"
-
-    for path in Path(rootpath).rglob(read_match):
-        matches.append(str(path.resolve()).replace(" ", "\\ "))
-    matches.sort()
-
-    logging.debug(f"read_match regex:\t{read_match}\nmatches:\t{matches}")
-    return matches
-
-
-def merge_fastq(jobs: list[tuple], merge_dir: str) -> list:
-    """
-    Merge all the lanes individual files into a single fastq
-
-    Args:
-        jobs (list): List of jobs to merge
-        merge_dir (str): Directory to save the merged files
-
-    Returns:
-        merge_names (list): List of all the merged files
-    """
-    logging.info("Beginning Lane Files Merge...")
-    merge_names = []
-    for job in jobs:
-        read_number, read_files, sample_id = job
-        r_string = " ".join(read_files)
-        merge_name = f"{sample_id}_R{read_number}.fastq"
-        if merge_dir:
-            merge_name = merge_dir + "/" + merge_name
-        if r_string.find("gz"):
-            merge_name += ".gz"
-        merge_names.append(merge_name)
-
-        logging.info(f"Merging {sample_id} R{read_number}...")
-
-        # TODO must test and handle non-zipped fastq files
-        with Path.open(merge_name, "wb") as concat:
-            for file in read_files:
-                shutil.copyfileobj(Path.open(file, "rb"), concat)
-                logging.info(f"Merge: {str(file).split('/')[-1]} -> {merge_name}")
-        logging.info(f"Done {merge_name}")
-
-    logging.info("Lane Files Merge Completed!")
-    logging.debug(f"Merge files final: {merge_names}")
-    return merge_names
-
-
-def parse_input_file(args: argparse.Namespace) -> list:
-    """
-    Parse input file and collect all reads for each job
-
-    Args:
-        args (argparse.Namespace): Parsed arguments from the user
-
-    Returns:
-        merge_jobs (list): List of all jobs to be merged
-    """
-    merge_jobs = []
-    with Path.open(args.file) as runlist:
-        logging.info("Parsing sample list...")
-        for line in runlist:
-            # Header line
-            if line.startswith("#"):
-                logging.info("Header Line...Skipping\n")
-                continue
-
-            sample_id = line.strip()
-            reads = ["1", "2"] if args.reads == 3 else args.reads
-
-            logging.debug(f"Sample:\t{sample_id}\tReads:\t{reads}")
-
-            for read in reads:
-                read_file_list = collect_reads(args.dir, sample_id, read)
-                if read_file_list == []:
-                    logging.warning(f"No files were found for SampleID {sample_id}! Skipping...")
-                else:
-                    merge_jobs.append([read, read_file_list, sample_id])
-
-    logging.info(f"{len(merge_jobs)} total jobs created.")
-
-    return merge_jobs
-
-
-def main(args: argparse.Namespace) -> None:
-    """Main function to run the FastQC pipeline"""
-    # Parse input for merge jobs
-    merge_jobs = parse_input_file(args)
-
-    # Merge all lanes into single file
-    qc_jobs = merge_fastq(merge_jobs, args.merge)
-
-    # Establish number of threads to use for FastQC
-    threads = args.threads
-    if threads == 0:
-        # args.threads=0 means auto-detect and either match threads to jobs or max out available threads
-        threads = len(qc_jobs) if len(qc_jobs) <= len(os.sched_getaffinity(0)) else len(os.sched_getaffinity(0))
-
-    # Pass the list of merged files to fastqc for processing
-    fqc = ["fastqc", "-t", str(threads)]
-    fqc.extend(qc_jobs)
-    logging.debug(f"FastQC Command: {fqc}")
-    subprocess.run(fqc, stdout=subprocess.PIPE, check=False)
-
-    # Cleanup intermediates/logging
-    if args.clean:
-        for file in qc_jobs:
-            Path.unlink(file)
-
-
-if __name__ == "__main__":
-    # Parse user arguments and spin up logging
-    args = arg_parser()
-    setup_logging(args.verbose)
-    logging.info("Logging started!")
-
-    # Validate runlist file
-    assert Path.is_file(args.file), f"Error: Input file ({args.file}) does not exist!"
-
-    # Check for valid thread count
-    max_threads = len(os.sched_getaffinity(0))
-    logging.debug(f"Cores reported: {max_threads}")
-    if args.threads > max_threads:
-        logging.warning(f"Too many threads requested! Maximum available on this machine is {max_threads}.")
-
-    # Create the desired merge directory if needed
-    if args.merge:
-        Path(args.merge).mkdir(parents=True, exist_ok=True)
-
-    # Check for FastQC install
-    app = shutil.which("fastqc")
-    logging.debug(f"Shutil reports app as {app}")
-    if app is not None:
-        try:
-            o = subprocess.check_output([app, "-h"], stderr=subprocess.STDOUT)
-        except ChildProcessError:
-            raise "FastQC application was not found!"
-
-    # Execute Pipeline
-    main(args)
+"""
+    FastQC Pipeline | RPINerd, 12/09/24
+
+    FastQC_pipe.py will take an input of run files and analyze them with the fastqc tool in a quasi-parallel mode.
+    Input format is expected to be a tab-delimited list of run directory, read file ID and reads (1/2/Both):
+
+    /path/to/run    Exp001_S1   Both
+    /path/to/run    Exp001_S2   1
+
+    or just the read file IDs, with the run directory given by --dir:
+
+    Exp001_S1
+    Exp001_S2
+    Exp001_S3
+"""
+
+import argparse
+import atexit
+import contextlib
+import csv
+import errno
+import functools
+import io
+import json
+import logging
+import logging.handlers
+import mmap
+import multiprocessing
+import os
+import queue
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import zipfile
+from collections import defaultdict
+from collections.abc import Callable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import NamedTuple
+
+try:
+    from isal import igzip, igzip_threaded
+except ImportError:
+    igzip = igzip_threaded = None
+
+# SampleID_L00#_R#_001.fastq(.gz)
+FASTQ_RE = re.compile(r"(?P<sid>.+)_L00(?P<lane>[1-4])_R(?P<r>[12])[^/]*\.fastq(?:\.gz)?$")
+
+# Suffixes of gzip (and BGZF) compressed fastq
+GZ_SUFFIXES = (".gz", ".bgz")
+
+# Buffer size for userspace copies, the 16 KB default costs far too many syscalls on modern (parallel) storage
+COPY_BUFFER = 16 << 20
+
+# Assumed FastQC throughput (bytes/s) and floor (s) used to derive a default per-file timeout
+FASTQC_RATE = 50e6
+FASTQC_MIN_TIMEOUT = 600
+
+# Seconds a timed out FastQC gets to exit after SIGTERM before it is SIGKILLed
+FASTQC_KILL_GRACE = 30
+
+# Largest source window mapped at once by the mmap merge fallback
+MMAP_WINDOW = 1 << 30
+
+# Tells a FastQC worker that no more merged files are coming
+QC_DONE = object()
+
+
+class Job(NamedTuple):
+    """A single sample/read merge job and its lane files, in lane order"""
+
+    read: str
+    files: tuple[str, ...]
+    sample: str
+
+
+class QCQueue(queue.Queue):
+    """Queue feeding the FastQC workers, which gives up on a put rather than block once every worker has died"""
+
+    def __init__(self, maxsize: int = 0) -> None:
+        super().__init__(maxsize)
+        self.workers = []
+
+    def put(self, item: object, block: bool = True, timeout: float | None = None) -> None:
+        """
+        Put an item on the queue, blocking only while some worker is still alive to take it
+
+        Args:
+            item (object): Merged file, Job or QC_DONE
+            block (bool): Same as queue.Queue.put
+            timeout (float): Same as queue.Queue.put
+
+        Returns:
+            None
+        """
+        if not block or timeout is not None:
+            return super().put(item, block, timeout)
+        while True:
+            if self.workers and all(worker.done() for worker in self.workers):
+                raise RuntimeError("Every FastQC worker has died!") from self.workers[0].exception()
+            with contextlib.suppress(queue.Full):
+                return super().put(item, timeout=1)
+
+
+def arg_parser() -> argparse.Namespace:
+    """Parse command line arguments"""
+    parser = argparse.ArgumentParser()
+
+    # TODO allow inferring of reads by just providing a target folder
+    input_type = parser.add_argument_group()
+    input_type.add_argument(
+        "-d",
+        "--dir",
+        help="Directory where all fastq files are stored, for input rows that only list a sample",
+        required=False,
+        default="",
+    )
+    input_type.add_argument(
+        "-f",
+        "--file",
+        help="Your input *.tsv/*.csv with list of fastq files",
+        required=True,
+    )
+
+    parser.add_argument(
+        "-t",
+        "--threads",
+        help="Number of simultaneous threads to run. By default it will use 1 thread per sample, \
+            or all available threads. Whichever is lower.",
+        required=False,
+        default=0,
+        type=int,
+    )
+    parser.add_argument(
+        "-m",
+        "--merge",
+        help="If desired, merge each sample's lanes and save the merged fastq files to this location for QC. \
+            Otherwise FastQC runs on the individual lane files.",
+        required=False,
+        default="",
+    )
+    parser.add_argument(
+        "-o",
+        "--outdir",
+        help="Directory to save the FastQC reports. By default they are saved next to each fastq.",
+        required=False,
+        default="",
+    )
+    parser.add_argument(
+        "--tmpdir",
+        help="Directory to stage FastQC's working files in. By default /dev/shm when available.",
+        required=False,
+        default="",
+    )
+    parser.add_argument(
+        "--no-merge",
+        help="Run FastQC directly on every individual lane file, even if --merge or --stream is given. \
+            This is the default.",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stream",
+        help="Concatenate each sample's lanes on the fly straight into FastQC, without writing a merged file",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--recompress",
+        help="Recompress the merged lanes into a single gzip stream (requires python-isal or pigz) instead of \
+            concatenating the raw gzip members",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--merge-mem-budget-gb",
+        help="Memory budget (GB) shared by the concurrent lane merges. By default half of the system memory.",
+        required=False,
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "-c",
+        "--clean",
+        help="After run, clean up the merge files from the disk",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-r",
+        "--reads",
+        help="Choose whether to limit QC to only R1 or R2. By defaut QC is run on both.",
+        required=False,
+        choices=[1, 2],
+        default=3,
+        type=int,
+    )
+    parser.add_argument(
+        "--fastqc-timeout",
+        help="Seconds to let a single FastQC run go before killing and retrying it once. By default it is \
+            scaled to the file size.",
+        required=False,
+        default=0,
+        type=float,
+    )
+    parser.add_argument(
+        "--polite",
+        help="Run FastQC (and the merge) at idle I/O and lowest CPU priority so co-located jobs are not starved. \
+            On by default.",
+        required=False,
+        default=True,
+        action=argparse.BooleanOptionalAction,
+    )
+    parser.add_argument(
+        "--skip-fastqc-check",
+        help="Don't launch FastQC to check it runs before starting, only that it is executable",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "--allow-partial",
+        help="Carry on with samples that are missing some of the run's lanes instead of aborting",
+        required=False,
+        action="store_true",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        help="Outputs a lot more information for debugging and saves log",
+        required=False,
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+
+    # Poll the usable cores once, everything downstream sizes itself off these
+    args.cpus = sorted(os.sched_getaffinity(0))
+    args.max_threads = len(args.cpus)
+
+    return args
+
+
+def setup_logging(verbose: bool) -> None:
+    """
+    Setup logging for the script
+
+    Args:
+        verbose (bool): If True, log all the things
+
+    Returns:
+        None
+    """
+    if verbose:
+        handler = logging.FileHandler("fastqc_pipe.log", mode="a", encoding="utf-8", delay=True)
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s", datefmt="%H:%M:%S"))
+        level = logging.DEBUG
+    else:
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s - %(message)s", datefmt="%M:%S"))
+        level = logging.INFO
+
+    # Worker threads only enqueue records, the formatting and I/O happen on the listener's thread
+    log_q = queue.Queue(-1)
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.addHandler(logging.handlers.QueueHandler(log_q))
+    listener = logging.handlers.QueueListener(log_q, handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+
+def _walk_fastqs(path: str) -> Iterator[tuple[re.Match, str]]:
+    """
+    Recursively walk a directory yielding every file that looks like a lane fastq
+
+    Args:
+        path (str): Directory to walk
+
+    Yields:
+        (match, path) (tuple): Filename regex match and the full path of the file
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk_fastqs(entry.path)
+            elif match := FASTQ_RE.match(entry.name):
+                yield match, entry.path
+
+
+@functools.cache
+def index_fastqs(rootpath: str) -> dict[str, dict[str, list[tuple[int, str]]]]:
+    """
+    Walk the run directory once and bin every lane file by sample and read number, cached per directory
+
+    Args:
+        rootpath (str): Root directory to search for files
+
+    Returns:
+        index (dict): (lane, path) of each lane file keyed by sample_id, then read_number
+    """
+    # Walking from an absolute root yields absolute paths without resolving (and stat'ing) each file
+    with os.scandir(os.path.abspath(rootpath)) as entries:
+        entries = list(entries)
+    subdirs = [entry.path for entry in entries if entry.is_dir(follow_symlinks=False)]
+    found = [
+        (match, entry.path)
+        for entry in entries
+        if not entry.is_dir(follow_symlinks=False) and (match := FASTQ_RE.match(entry.name))
+    ]
+
+    # Each readdir is a round trip on networked storage, so walk the top level subdirectories concurrently
+    if subdirs:
+        with ThreadPoolExecutor(max_workers=min(32, len(subdirs))) as ex:
+            for matches in ex.map(lambda subdir: list(_walk_fastqs(subdir)), subdirs):
+                found.extend(matches)
+
+    index = defaultdict(lambda: defaultdict(list))
+    for match, path in found:
+        index[match["sid"]][match["r"]].append((int(match["lane"]), path))
+
+    logging.debug(f"Indexed {len(found)} fastq files under {rootpath}")
+    # Plain dicts so later lookups of unknown samples can't grow the cached index
+    return {sample_id: dict(reads) for sample_id, reads in index.items()}
+
+
+def collect_reads(index: dict[str, dict[str, list[tuple[int, str]]]], readset: str) -> dict[str, list[str]]:
+    """
+    Sub to hunt down red oct.. I mean all the individual lane files for each readset, both reads in one go
+
+    Args:
+        index (dict): (lane, path) of each lane file keyed by sample_id, then read_number, from index_fastqs
+        readset (str): Sample ID to search for
+
+    Returns:
+        matches (dict): List of all files found for the readset, keyed by read number
+    """
+    # Order by the lane number parsed from the filename so concatenation is always L001 -> L004, whatever the path
+    matches = {read: [path for _, path in sorted(files)] for read, files in index.get(readset, {}).items()}
+
+    logging.debug(f"readset:\t{readset}\nmatches:\t{matches}")
+    return matches
+
+
+def _is_gz(files: tuple | list) -> bool:
+    """
+    Check whether a set of lane files is gzipped, they must all agree for a merge to make sense
+
+    Args:
+        files (tuple): Lane files of a single job
+
+    Returns:
+        is_gz (bool): True if the lane files are gzipped
+    """
+    is_gz = files[0].endswith(GZ_SUFFIXES)
+    assert all(file.endswith(GZ_SUFFIXES) == is_gz for file in files), (
+        f"Error: lane files mix compressed and uncompressed fastq: {files}"
+    )
+    return is_gz
+
+
+def _gz_readers(files: tuple | list, threads: int = 1) -> list[list[str]]:
+    """
+    Build the commands decompressing gzipped lanes to stdout with the fastest tool on the PATH
+
+    rapidgzip decodes a single gzip file across many cores (faster still with a <lane>.gzi index exported by
+    `rapidgzip --export-index`), pigz is next best and plain zcat is the fallback.
+
+    Args:
+        files (tuple): Gzipped lane files, in order
+        threads (int): Number of decompression threads to allow
+
+    Returns:
+        readers (list): Commands to run in order, together writing the decompressed lanes to stdout
+    """
+    if shutil.which("rapidgzip"):
+        # One input file per rapidgzip call, using a prebuilt <lane>.gzi index when there is one
+        readers = []
+        for file in files:
+            index = ["--import-index", f"{file}.gzi"] if Path(f"{file}.gzi").is_file() else []
+            readers.append(["rapidgzip", "-d", "-c", "-P", str(threads), *index, file])
+        return readers
+    if shutil.which("pigz"):
+        return [["pigz", "-d", "-c", "-p", str(threads), *files]]
+    return [["zcat", *files]]
+
+
+def _setup_worker_logging(log_q: multiprocessing.Queue, level: int) -> None:
+    """
+    Setup logging inside a merge worker process, which does not inherit the parent's handlers
+
+    Args:
+        log_q (multiprocessing.Queue): Queue the parent forwards on to its own handlers
+        level (int): Logging level of the parent process
+
+    Returns:
+        None
+    """
+    # Send everything back to the parent so it lands in the same place (terminal or log file) as the rest
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_q)]
+    root.setLevel(level)
+
+
+def _merge_strategy(recompress: bool) -> str:
+    """
+    Pick the fastest merge mechanism available on this machine
+
+    Args:
+        recompress (bool): If True, the merged lanes need re-deflating into a single gzip stream
+
+    Returns:
+        strategy (str): One of "isal", "pigz", "sendfile", "cat", "mmap" or "shutil"
+    """
+    if recompress:
+        if igzip_threaded is not None:
+            strategy = "isal"
+        elif shutil.which("pigz"):
+            strategy = "pigz"
+        else:
+            raise RuntimeError("Recompression requires either python-isal or pigz!")
+    elif hasattr(os, "sendfile"):
+        strategy = "sendfile"
+    # cat copies in the kernel where it can without bouncing through Python, so it beats copyfileobj
+    elif shutil.which("cat"):
+        strategy = "cat"
+    elif hasattr(os, "writev"):
+        strategy = "mmap"
+    else:
+        strategy = "shutil"
+
+    logging.debug(f"Merge strategy: {strategy}")
+    return strategy
+
+
+def _kernel_copy(src: int, dst: int) -> None:
+    """
+    Append a whole file to another without the data ever entering userspace
+
+    copy_file_range is tried first as it can reflink on CoW filesystems or copy server side on NFS 4.2,
+    falling back to sendfile where the kernel or filesystem doesn't support it.
+
+    Args:
+        src (int): File descriptor to copy from
+        dst (int): File descriptor to append to
+
+    Returns:
+        None
+    """
+    # Both calls copy in the kernel and release the GIL while they do it
+    if hasattr(os, "copy_file_range"):
+        try:
+            while os.copy_file_range(src, dst, 1 << 30) > 0:
+                pass
+            return
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                raise
+    while os.sendfile(dst, src, None, 1 << 20) > 0:
+        pass
+
+
+def _mmap_copy(src: int, dst: int) -> None:
+    """
+    Append a whole file to another by mapping it in windows and gather-writing each one
+
+    Args:
+        src (int): File descriptor to copy from
+        dst (int): File descriptor to append to
+
+    Returns:
+        None
+    """
+    size = os.fstat(src).st_size
+    # Prefault the whole window up front so the write never stalls on page faults
+    flags = mmap.MAP_PRIVATE | getattr(mmap, "MAP_POPULATE", 0)
+    for offset in range(0, size, MMAP_WINDOW):
+        length = min(MMAP_WINDOW, size - offset)
+        with mmap.mmap(src, length, flags=flags, prot=mmap.PROT_READ, offset=offset) as mm:
+            view = memoryview(mm)
+            try:
+                while view:
+                    view = view[os.writev(dst, [view]) :]
+            finally:
+                view.release()
+
+
+def _drop_cache(path: str) -> None:
+    """
+    Tell the kernel a file won't be read again so its pages can go before anything hotter
+
+    Args:
+        path (str): File to drop from the page cache
+
+    Returns:
+        None
+    """
+    if not hasattr(os, "posix_fadvise"):
+        return
+    with contextlib.suppress(OSError):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def _merge_one(job: tuple[tuple, str, str, int]) -> str:
+    """
+    Concatenate all the lane files of a single job into one merged file
+
+    Args:
+        job (tuple): Tuple of the lane files to concatenate, the merged file name, the merge strategy
+            from _merge_strategy and the number of compression threads for the recompress strategies
+
+    Returns:
+        merge_name (str): Path of the merged file
+    """
+    read_files, merge_name, strategy, recompress_threads = job
+    is_gz = _is_gz(read_files)
+
+    # An earlier run may have left a link to a source lane under this name, writing through it would clobber the lane
+    Path(merge_name).unlink(missing_ok=True)
+
+    # A lone lane needs no concatenation, just link it under the merged name
+    if len(read_files) == 1 and strategy not in ("isal", "pigz"):
+        if os.stat(read_files[0]).st_dev == os.stat(Path(merge_name).parent).st_dev:
+            try:
+                os.link(read_files[0], merge_name)
+            except OSError:
+                os.symlink(os.path.abspath(read_files[0]), merge_name)
+        else:
+            os.symlink(os.path.abspath(read_files[0]), merge_name)
+        logging.info(f"Linked {str(read_files[0]).split('/')[-1]} -> {merge_name}")
+        return merge_name
+
+    if strategy == "isal":
+        # Decode every lane and re-deflate into one gzip member with ISA-L's SIMD deflate
+        with igzip_threaded.open(merge_name, "wb", compresslevel=1, threads=recompress_threads) as dst:
+            for file in read_files:
+                opener = igzip.open if is_gz else Path.open
+                with opener(file, "rb") as src:
+                    shutil.copyfileobj(src, dst, length=COPY_BUFFER)
+                logging.info(f"Merge: {str(file).split('/')[-1]} -> {merge_name}")
+
+    elif strategy == "cat":
+        # Hand the byte shuffling to cat entirely, no shell needed for the redirect
+        with Path(merge_name).open("wb") as out:
+            subprocess.run(["cat", *read_files], stdout=out, check=True)
+
+    elif strategy == "pigz":
+        # Decompress (or cat) each lane straight into a pigz writer
+        readers = _gz_readers(read_files, recompress_threads) if is_gz else [["cat", *read_files]]
+        with Path(merge_name).open("wb") as out:
+            pigz = ["pigz", "-c", "-1", "-p", str(recompress_threads)]
+            writer = subprocess.Popen(pigz, stdin=subprocess.PIPE, stdout=out)
+            try:
+                for reader in readers:
+                    logging.debug(f"Merge command: {reader} | pigz")
+                    subprocess.run(reader, stdout=writer.stdin, check=True)
+            finally:
+                writer.stdin.close()
+                writer.wait()
+        if writer.returncode:
+            raise subprocess.CalledProcessError(writer.returncode, writer.args)
+        logging.info(f"Merge: {len(read_files)} lane files -> {merge_name}")
+
+    else:
+        dst = os.open(merge_name, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            for file in read_files:
+                src = os.open(file, os.O_RDONLY)
+                try:
+                    # Ask for aggressive readahead on the way in
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(src, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+                    if strategy == "sendfile":
+                        _kernel_copy(src, dst)
+                    elif strategy == "mmap":
+                        _mmap_copy(src, dst)
+                    else:
+                        with (
+                            os.fdopen(src, "rb", buffering=COPY_BUFFER, closefd=False) as s,
+                            os.fdopen(dst, "wb", buffering=COPY_BUFFER, closefd=False) as d,
+                        ):
+                            shutil.copyfileobj(s, d, length=COPY_BUFFER)
+                    # The lane is done with, drop it from the page cache so the merged file FastQC reads next stays hot
+                    if hasattr(os, "posix_fadvise"):
+                        os.posix_fadvise(src, 0, 0, os.POSIX_FADV_DONTNEED)
+                finally:
+                    os.close(src)
+                logging.info(f"Merge: {str(file).split('/')[-1]} -> {merge_name}")
+        finally:
+            os.close(dst)
+
+    logging.info(f"Done {merge_name}")
+    return merge_name
+
+
+def merge_fastq(
+    jobs: list[Job],
+    merge_dir: str,
+    recompress: bool = False,
+    qc_queue: queue.Queue | None = None,
+    mem_budget_gb: float = 0,
+    cores: int = 1,
+) -> list:
+    """
+    Merge all the lanes individual files into a single fastq
+
+    Args:
+        jobs (list): List of jobs to merge
+        merge_dir (str): Directory to save the merged files
+        recompress (bool): If True, recompress the merged lanes into a single gzip stream
+        qc_queue (queue.Queue): If given, each merged file is put on the queue as soon as it is done
+        mem_budget_gb (float): Memory budget in GB for all concurrent merges, 0 for half the system memory
+        cores (int): Number of cores this process may run on, shared by the merges and their compression threads
+
+    Returns:
+        merge_names (list): List of all the merged files
+    """
+    logging.info("Beginning Lane Files Merge...")
+    jobs_with_names = []
+    strategy = _merge_strategy(recompress)
+    recompress_threads = max(2, cores // max(1, len(jobs))) if recompress else 0
+    for job in jobs:
+        read_number, read_files, sample_id = job.read, job.files, job.sample
+
+        # Gzip members can be concatenated as-is, so compressed lanes are copied raw without decompressing
+        is_gz = _is_gz(read_files)
+        suffix = ".fastq.gz" if is_gz or recompress else ".fastq"
+        merge_name = f"{sample_id}_R{read_number}{suffix}"
+        if merge_dir:
+            merge_name = merge_dir + "/" + merge_name
+        jobs_with_names.append((read_files, merge_name, strategy, recompress_threads))
+
+        logging.info(f"Queued {sample_id} R{read_number} for merge...")
+
+    def merge_and_queue(job: tuple[tuple, str, str, int]) -> str:
+        merge_name = _merge_one(job)
+        if qc_queue is not None:
+            qc_queue.put(merge_name)
+        return merge_name
+
+    # Run the merges side by side, but only as many as the memory budget allows
+    merge_names = []
+    if jobs_with_names:
+        if mem_budget_gb:
+            budget_bytes = int(mem_budget_gb * (1 << 30))
+        else:
+            budget_bytes = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2
+        per_job_buffer = 2 * COPY_BUFFER
+        # Recompressing merges each bring their own compression threads, so meter them against the cores
+        cpu_slots = cores // max(1, recompress_threads)
+        workers = max(1, min(len(jobs_with_names), budget_bytes // per_job_buffer, cpu_slots))
+        logging.info(
+            f"Merging with {workers} workers ({budget_bytes >> 20} MB budget, {per_job_buffer >> 20} MB per merge)"
+        )
+        if strategy == "isal":
+            # ISA-L recompression is CPU bound, so give each merge its own interpreter to stay clear of the GIL
+            ctx = multiprocessing.get_context("forkserver")
+            root = logging.getLogger()
+            worker_log_q = ctx.Queue()
+            forwarder = logging.handlers.QueueListener(worker_log_q, *root.handlers)
+            forwarder.start()
+            pool = ctx.Pool(processes=workers, initializer=_setup_worker_logging, initargs=(worker_log_q, root.level))
+            try:
+                with pool:
+                    for merge_name in pool.imap_unordered(_merge_one, jobs_with_names):
+                        merge_names.append(merge_name)
+                        if qc_queue is not None:
+                            qc_queue.put(merge_name)
+                        logging.info(f"Merged {len(merge_names)}/{len(jobs_with_names)}")
+                    # Let the workers exit cleanly so their last log records are flushed, not lost to terminate()
+                    pool.close()
+                    pool.join()
+            finally:
+                forwarder.stop()
+        else:
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                futures = [ex.submit(merge_and_queue, job) for job in jobs_with_names]
+                for future in as_completed(futures):
+                    merge_names.append(future.result())
+                    logging.info(f"Merged {len(merge_names)}/{len(jobs_with_names)}")
+
+    logging.info("Lane Files Merge Completed!")
+    logging.debug(f"Merge files final: {merge_names}")
+    return merge_names
+
+
+def _feed_lanes(files: tuple, pipe: io.BufferedWriter, threads: int = 1) -> int:
+    """
+    Concatenate lane files into a pipe, decompressing gzipped ones, then close it to signal EOF
+
+    Args:
+        files (tuple): Lane files to feed, in order
+        pipe (io.BufferedWriter): Write end of the pipe
+        threads (int): Number of threads to decompress gzipped lanes with
+
+    Returns:
+        status (int): 0 once every lane is fed, else the failing decompressor's exit status (-SIGPIPE if
+            FastQC stopped reading)
+    """
+    try:
+        if _is_gz(files):
+            # The readers write straight into the pipe, and die of SIGPIPE if its reader goes away
+            for reader in _gz_readers(files, threads):
+                status = subprocess.run(reader, stdout=pipe, stderr=subprocess.DEVNULL, check=False).returncode
+                # Carrying on past a corrupt or truncated lane would QC a silently shortened sample
+                if status:
+                    logging.debug(f"Feed command {reader} exited with status {status}")
+                    return status
+        else:
+            for file in files:
+                with Path(file).open("rb") as src:
+                    if hasattr(os, "sendfile"):
+                        while os.sendfile(pipe.fileno(), src.fileno(), None, 1 << 20) > 0:
+                            pass
+                    else:
+                        shutil.copyfileobj(src, pipe, COPY_BUFFER)
+    except BrokenPipeError:
+        # The reader went away (most likely killed on timeout), nothing left to do
+        return -signal.SIGPIPE
+    finally:
+        with contextlib.suppress(BrokenPipeError):
+            pipe.close()
+    return 0
+
+
+def _run_fastqc(fqc: list[str], timeout: float, feed: tuple = (), feed_threads: int = 1) -> int | None:
+    """
+    Run a single FastQC command in its own session, killing the whole process group if it stalls
+
+    Args:
+        fqc (list): FastQC command to run
+        timeout (float): Seconds to wait before giving up on the run
+        feed (tuple): If given, lane files concatenated (and decompressed if gzipped) into FastQC's stdin
+        feed_threads (int): Number of threads to decompress gzipped feed lanes with
+
+    Returns:
+        status (int): FastQC's exit status, None if it timed out
+    """
+    # Nobody reads FastQC's progress output, so don't let it back up into a pipe
+    proc = subprocess.Popen(
+        fqc,
+        stdin=subprocess.PIPE if feed else None,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    feeder = None
+    if feed:
+        feeder = ThreadPoolExecutor(max_workers=1)
+        fed = feeder.submit(_feed_lanes, feed, proc.stdin, feed_threads)
+
+    # Block on the exit itself rather than Popen.wait(timeout)'s sleep/poll loop, a timer handles stalls
+    expired = threading.Event()
+    # Held while deciding to kill and once the wait returns, so a run finishing as the timer fires is left alone
+    reaped = threading.Lock()
+
+    def kill_session(sig: signal.Signals) -> None:
+        with reaped:
+            if proc.returncode is not None:
+                return
+            expired.set()
+            # Take the wrappers and the JVM down with it
+            with contextlib.suppress(ProcessLookupError):
+                os.killpg(proc.pid, sig)
+
+    # A JVM that shrugs off SIGTERM would block the wait forever, so follow up with SIGKILL
+    killers = [
+        threading.Timer(timeout, kill_session, (signal.SIGTERM,)),
+        threading.Timer(timeout + FASTQC_KILL_GRACE, kill_session, (signal.SIGKILL,)),
+    ]
+    for killer in killers:
+        killer.start()
+    try:
+        proc.wait()
+    finally:
+        with reaped:
+            for killer in killers:
+                killer.cancel()
+        if feeder is not None:
+            feeder.shutdown()
+    # A run that exited cleanly just as the timer fired still counts as finished
+    if expired.is_set() and proc.returncode != 0:
+        return None
+
+    # FastQC exits cleanly on a short stream, so a failed feed has to fail the run. SIGPIPE is only
+    # expected once FastQC itself has gone away, which is already a failure
+    feed_status = fed.result() if feeder is not None else 0
+    if feed_status and (proc.returncode == 0 or feed_status != -signal.SIGPIPE):
+        logging.error(f"Feeding {len(feed)} lanes into FastQC failed with exit status {feed_status}!")
+        return proc.returncode or feed_status
+    return proc.returncode
+
+
+def _wrap_fastqc(fqc: list[str], cpu_set: list[int] | None = None, polite: bool = False) -> list[str]:
+    """
+    Wrap a FastQC command with the optional priority and core pinning launchers
+
+    Args:
+        fqc (list): FastQC command to wrap
+        cpu_set (list): If given, pin FastQC to these cores
+        polite (bool): If True, run FastQC at idle I/O priority and lowest CPU priority
+
+    Returns:
+        fqc (list): The wrapped command
+    """
+    if polite and shutil.which("ionice"):
+        fqc = ["ionice", "-c", "3", "nice", "-n", "19", *fqc]
+    if cpu_set:
+        fqc = ["taskset", "-c", ",".join(map(str, cpu_set)), *fqc]
+    return fqc
+
+
+def _collect_report(report_dir: str, stem: str, dest: Callable[[str], Path]) -> bool:
+    """
+    Move one input's finished FastQC report out of staging
+
+    Args:
+        report_dir (str): Staging directory FastQC writes its reports to
+        stem (str): Report name minus the _fastqc.* suffix, from _report_stem
+        dest (Callable): Maps a report file name to the directory it belongs in
+
+    Returns:
+        collected (bool): True if the report was complete and has been moved
+    """
+    html, archive = (Path(report_dir) / f"{stem}_fastqc.{ext}" for ext in ("html", "zip"))
+    # A run killed part way can leave a half written archive behind, only take a report that is whole
+    if not (html.is_file() and zipfile.is_zipfile(archive)):
+        return False
+    for report in (html, archive):
+        shutil.move(report, dest(report.name) / report.name)
+    return True
+
+
+def _qc_and_collect(
+    make_fqc: Callable[[list[str]], list[str]],
+    qc_inputs: list[str],
+    qc_name: str,
+    report_dir: str,
+    dest: Callable[[str], Path],
+    timeout: float,
+    feed: tuple = (),
+    feed_threads: int = 1,
+) -> int:
+    """
+    Run FastQC on staged inputs, retrying the unfinished ones once on a stall, and move the reports out of staging
+
+    Args:
+        make_fqc (Callable): Builds the FastQC command for a list of inputs, writing its output to report_dir
+        qc_inputs (list): Files (or stdin:<name>) to QC
+        qc_name (str): Name to log the run under
+        report_dir (str): Staging directory the reports are written to, removed afterwards
+        dest (Callable): Maps a report file name to the directory it belongs in
+        timeout (float): Seconds allowed per attempt
+        feed (tuple): If given, lane files concatenated (and decompressed) into FastQC's stdin
+        feed_threads (int): Number of threads to decompress gzipped feed lanes with
+
+    Returns:
+        failed (int): Number of inputs FastQC failed on
+    """
+    pending = list(qc_inputs)
+    for attempt in range(2):
+        fqc = make_fqc(pending)
+        logging.debug(f"FastQC Command: {fqc}")
+        status = _run_fastqc(fqc, timeout, feed, feed_threads)
+
+        # Keep whatever finished before a stall or a bad file, but never a report of a stream that broke off
+        if status == 0 or not feed:
+            pending = [
+                qc_input for qc_input in pending if not _collect_report(report_dir, _report_stem(qc_input), dest)
+            ]
+
+        # A FastQC stall must not hang the whole pipeline, give what is left one retry before moving on
+        if status is not None or not pending or attempt:
+            break
+        logging.warning(f"FastQC timed out after {timeout:.0f}s on {qc_name}, retrying {len(pending)} inputs...")
+    shutil.rmtree(report_dir, ignore_errors=True)
+
+    if pending:
+        if status is None:
+            reason = "timed out twice"
+        else:
+            reason = f"exited with status {status}" if status else "wrote no report"
+        logging.error(f"FastQC {reason} on {qc_name}, no report for: {', '.join(map(_report_stem, pending))}")
+        return len(pending)
+    if status:
+        # Every report is there but FastQC still complained, there's no telling which one to distrust
+        logging.error(f"FastQC exited with status {status} on {qc_name}!")
+        return len(qc_inputs)
+    logging.info(f"FastQC done {qc_name}")
+    return 0
+
+
+def _report_stem(file: str) -> str:
+    """
+    Work out the name FastQC gives a file's report, minus the _fastqc.* suffix
+
+    Args:
+        file (str): Path of the fastq
+
+    Returns:
+        stem (str): File name with its compression and fastq extensions stripped
+    """
+    stem = Path(file).name.removeprefix("stdin:")
+    for suffixes in ((".gz", ".bz2"), (".fastq", ".fq")):
+        for suffix in suffixes:
+            stem = stem.removesuffix(suffix)
+    return stem
+
+
+def fastqc_batch(
+    files: list[str], staging: str, outdir: str = "", threads: int = 1, polite: bool = False, timeout: float = 0
+) -> int:
+    """
+    Run one FastQC over every file at once, letting FastQC spread the files across its threads
+
+    Args:
+        files (list): Fastq files to QC
+        staging (str): Scratch directory (ideally tmpfs) FastQC writes its reports and temp files to
+        outdir (str): Directory the finished reports are moved to, next to each fastq if empty
+        threads (int): Number of files FastQC processes in parallel
+        polite (bool): If True, run FastQC at idle I/O priority and lowest CPU priority
+        timeout (float): Seconds allowed for the whole run, 0 to scale it to the total size
+
+    Returns:
+        failed (int): Number of files FastQC failed on
+    """
+    # Without any files FastQC would open its GUI
+    if not files:
+        return 0
+
+    # Reports are named after the file alone, so lanes sharing a name (the same sample under two run
+    # directories) would overwrite each other in staging. Split them over as few separate runs as it takes
+    batches = []
+    for file in files:
+        stem = _report_stem(file)
+        batch = next((batch for batch in batches if stem not in batch), None)
+        if batch is None:
+            batch = {}
+            batches.append(batch)
+        batch[stem] = file
+    if len(batches) > 1:
+        logging.info(f"Some report names clash, running FastQC in {len(batches)} batches")
+        return sum(
+            fastqc_batch(list(batch.values()), staging, outdir, min(threads, len(batch)), polite, timeout)
+            for batch in batches
+        )
+
+    # Stage the many small report files on scratch and only move the finished reports to the real output
+    report_dir = tempfile.mkdtemp(dir=staging)
+
+    def make_fqc(qc_inputs: list[str]) -> list[str]:
+        fqc = ["fastqc", "-t", str(min(threads, len(qc_inputs))), "--outdir", report_dir, "--dir", report_dir]
+        return _wrap_fastqc([*fqc, *qc_inputs], polite=polite)
+
+    # Reports land next to the fastq they came from unless an outdir was given
+    parents = {_report_stem(file): Path(file).parent for file in files}
+
+    # Each file gets a single FastQC thread, so the largest one sets a floor on the run however many threads
+    sizes = [Path(file).stat().st_size for file in files]
+    run_timeout = timeout or max(FASTQC_MIN_TIMEOUT, sum(sizes) / (FASTQC_RATE * threads), max(sizes) / FASTQC_RATE)
+    return _qc_and_collect(
+        make_fqc,
+        files,
+        f"{len(files)} files",
+        report_dir,
+        lambda name: Path(outdir or parents[name.rsplit("_fastqc", 1)[0]]),
+        run_timeout,
+    )
+
+
+def fastqc_worker(
+    qc_queue: queue.Queue,
+    staging: str,
+    outdir: str = "",
+    cpu_set: list[int] | None = None,
+    polite: bool = False,
+    timeout: float = 0,
+    decomp_threads: int = 1,
+) -> int:
+    """
+    Run FastQC on each merged file (or streamed Job) pulled off the queue until told to stop
+
+    Args:
+        qc_queue (queue.Queue): Queue of merged files or Jobs to stream, terminated by QC_DONE
+        staging (str): Scratch directory (ideally tmpfs) FastQC writes its reports and temp files to
+        outdir (str): Directory the finished reports are moved to, next to each fastq if empty
+        cpu_set (list): If given, pin every FastQC instance of this worker to these cores
+        polite (bool): If True, run FastQC at idle I/O priority and lowest CPU priority
+        timeout (float): Seconds allowed per FastQC run, 0 to scale it to the file size
+        decomp_threads (int): Threads each streamed Job may use to decompress gzipped lanes
+
+    Returns:
+        failed (int): Number of files FastQC failed on
+    """
+    failed = 0
+    while (target := qc_queue.get()) is not QC_DONE:
+        # A Job is concatenated on the fly straight into FastQC's stdin, with no merged file on disk
+        if isinstance(target, Job):
+            qc_name = f"{target.sample}_R{target.read}.fastq"
+            files = target.files
+            qc_input = f"stdin:{qc_name}"
+        else:
+            qc_name = target
+            files = (target,)
+            qc_input = target
+
+        # One bad file (full scratch, unwritable outdir...) must not kill the worker, the queue still needs draining
+        report_dir = None
+        try:
+            # Stage the many small report files on scratch and only move the finished reports to the real output
+            report_dir = tempfile.mkdtemp(dir=staging)
+
+            # FastQC only ever uses one thread per file, so one instance per file is all it needs
+            fqc = ["fastqc", "-t", "1", "--outdir", report_dir, "--dir", report_dir]
+            fqc = _wrap_fastqc(fqc, cpu_set, polite)
+            # Streamed lanes are fed to FastQC's stdin from here
+            feed = files if isinstance(target, Job) else ()
+
+            size = sum(Path(f).stat().st_size for f in files)
+            run_timeout = timeout or max(FASTQC_MIN_TIMEOUT, size / FASTQC_RATE)
+            dest = Path(outdir or Path(files[0]).parent)
+            failed += _qc_and_collect(
+                lambda qc_inputs: [*fqc, *qc_inputs],
+                [qc_input],
+                qc_name,
+                report_dir,
+                lambda _: dest,
+                run_timeout,
+                feed,
+                decomp_threads,
+            )
+
+            # A kept merged file has been read for the last time, don't let it push the next merge out of the cache
+            if not feed:
+                _drop_cache(target)
+        except Exception:
+            logging.exception(f"FastQC failed on {qc_name}! Skipping...")
+            failed += 1
+            if report_dir is not None:
+                shutil.rmtree(report_dir, ignore_errors=True)
+    return failed
+
+
+def qc_mode(args: argparse.Namespace) -> str:
+    """
+    Work out what FastQC is run on from the user's options
+
+    Args:
+        args (argparse.Namespace): Parsed arguments from the user
+
+    Returns:
+        mode (str): "lanes" to QC each lane file as-is (default), "merge" to QC merged files written to disk
+            or "stream" to QC each sample's lanes concatenated on the fly
+    """
+    if args.no_merge:
+        return "lanes"
+    if args.merge or args.recompress:
+        return "merge"
+    if args.stream:
+        return "stream"
+    return "lanes"
+
+
+def parse_input_file(args: argparse.Namespace) -> list[Job]:
+    """
+    Parse input file and collect all reads for each job
+
+    Args:
+        args (argparse.Namespace): Parsed arguments from the user
+
+    Returns:
+        merge_jobs (list): List of all Jobs to be merged
+    """
+    merge_jobs = []
+    incomplete = []
+    run_lanes = {}
+    run_reads = {}
+    arg_reads = ["1", "2"] if args.reads == 3 else [str(args.reads)]
+
+    logging.info("Parsing sample list...")
+    samples = []
+    with Path(args.file).open(newline="") as runlist:
+        for row in csv.reader(runlist, delimiter="\t"):
+            row = [col.strip() for col in row]
+            # Blank and header lines
+            if not row or not row[0] or row[0].startswith("#"):
+                continue
+
+            # Either "Path  Sample  R1/2/Both" or just "Sample" with the path from --dir
+            if len(row) == 1:
+                rootpath, sample_id, reads = args.dir, row[0], arg_reads
+            else:
+                rootpath, sample_id = row[0], row[1]
+                row_reads = row[2].upper().removeprefix("R") if len(row) > 2 else "BOTH"
+                reads = [r for r in arg_reads if row_reads in ("BOTH", r)]
+            assert rootpath, f"Error: no fastq directory for SampleID {sample_id}, add it to the row or use --dir!"
+            samples.append((rootpath, sample_id, reads))
+
+    # A mistyped directory only loses its own samples, same as a mistyped SampleID
+    missing_dirs = {rootpath for rootpath, _, _ in samples if not Path(rootpath).is_dir()}
+    for rootpath in sorted(missing_dirs):
+        logging.warning(f"Directory {rootpath} was not found! Skipping its samples...")
+    samples = [sample for sample in samples if sample[0] not in missing_dirs]
+
+    # Directory walks are latency bound on networked storage, so index every run directory side by side
+    rootpaths = list(dict.fromkeys(rootpath for rootpath, _, _ in samples))
+    if rootpaths:
+        with ThreadPoolExecutor(max_workers=min(32, len(rootpaths))) as ex:
+            for rootpath, index in zip(rootpaths, ex.map(index_fastqs, rootpaths)):
+                # Every sample is expected to cover all the lanes seen anywhere in its run directory
+                run_lanes[rootpath] = {
+                    lane for reads in index.values() for files in reads.values() for lane, _ in files
+                }
+                # ...and every read the run has, a single end run just never has an R2
+                run_reads[rootpath] = {read for reads in index.values() for read in reads}
+                logging.debug(f"Lanes in {rootpath}: {sorted(run_lanes[rootpath])}")
+
+    for rootpath, sample_id, reads in samples:
+        logging.debug(f"Sample:\t{sample_id}\tPath:\t{rootpath}\tReads:\t{reads}")
+        index = index_fastqs(rootpath)
+        sample_reads = collect_reads(index, sample_id)
+
+        sample_jobs = []
+        for read in reads:
+            read_file_list = sample_reads.get(read, [])
+            if read_file_list == []:
+                logging.warning(f"No files were found for SampleID {sample_id} R{read}! Skipping...")
+            else:
+                # Catch lanes mixing gzipped and plain fastq before any merge or stream starts
+                if qc_mode(args) != "lanes":
+                    _is_gz(read_file_list)
+                sample_jobs.append(Job(read, tuple(read_file_list), sample_id))
+        merge_jobs.extend(sample_jobs)
+
+        # A truncated merge would pass QC while silently missing data, so check every lane is there.
+        # QC'ing the lanes one by one can't truncate anything
+        if sample_jobs and qc_mode(args) != "lanes":
+            present = {(job.read, lane) for job in sample_jobs for lane, _ in index[sample_id][job.read]}
+            expected = {(read, lane) for read in reads if read in run_reads[rootpath] for lane in run_lanes[rootpath]}
+            missing = expected - present
+            if missing:
+                incomplete.append(sample_id)
+                lanes = ", ".join(f"R{r} L00{lane}" for r, lane in sorted(missing))
+                logging.error(f"SampleID {sample_id} is missing lane files: {lanes}")
+
+    if incomplete and not args.allow_partial:
+        logging.error(f"{len(incomplete)} samples have missing lanes, rerun with --allow-partial to QC them anyway.")
+        sys.exit(2)
+
+    # Work through one directory at a time in on-disk order, keeping the dentry cache warm and the disk heads sweeping
+    merge_jobs.sort(key=lambda job: (os.path.dirname(job.files[0]), os.stat(job.files[0]).st_ino))
+
+    logging.info(f"{len(merge_jobs)} total jobs created.")
+
+    return merge_jobs
+
+
+def run_qc_workers(
+    args: argparse.Namespace, merge_jobs: list[Job], mode: str, staging: str, threads: int
+) -> tuple[list, int]:
+    """
+    Feed merged files or streamed Jobs to a pool of single file FastQC workers
+
+    Args:
+        args (argparse.Namespace): Parsed arguments from the user
+        merge_jobs (list): List of all Jobs to QC
+        mode (str): "merge" or "stream", from qc_mode
+        staging (str): Scratch directory FastQC writes its reports and temp files to
+        threads (int): Number of FastQC workers
+
+    Returns:
+        qc_jobs (list): List of the merged files, empty when streaming
+        failed (int): Number of files FastQC failed on
+    """
+    qc_jobs = []
+    qc_queue = QCQueue(maxsize=2 * threads)
+    # Give each FastQC worker its own contiguous block of cores, which on the usual numbering keeps a JVM on one
+    # socket instead of migrating between them. With more workers than cores they double up one core each
+    cpus = args.cpus
+    cpu_sets = [
+        cpus[i * len(cpus) // threads : (i + 1) * len(cpus) // threads] or [cpus[i % len(cpus)]] for i in range(threads)
+    ]
+    if not shutil.which("taskset"):
+        cpu_sets = [None] * threads
+
+    # Split the cores evenly between the concurrent streamed decompressions, they run alongside the FastQC workers
+    decomp_threads = max(1, args.max_threads // threads)
+
+    with ThreadPoolExecutor(max_workers=threads) as qc_pool:
+        for cpu_set in cpu_sets:
+            worker = qc_pool.submit(
+                fastqc_worker,
+                qc_queue,
+                staging,
+                args.outdir,
+                cpu_set,
+                args.polite,
+                args.fastqc_timeout,
+                decomp_threads,
+            )
+            qc_queue.workers.append(worker)
+        try:
+            if mode == "stream":
+                for job in merge_jobs:
+                    qc_queue.put(job)
+            else:
+                qc_jobs = merge_fastq(
+                    merge_jobs, args.merge, args.recompress, qc_queue, args.merge_mem_budget_gb, args.max_threads
+                )
+        finally:
+            # Only fails once every worker is gone, and then there is nobody left to stop
+            with contextlib.suppress(RuntimeError):
+                for _ in range(threads):
+                    qc_queue.put(QC_DONE)
+
+    # Surface anything that killed a worker outright
+    failed = sum(worker.result() for worker in qc_queue.workers)
+
+    return qc_jobs, failed
+
+
+def check_fastqc(app: str, skip: bool) -> None:
+    """
+    Make sure FastQC actually runs, remembering a good install so the JVM isn't started just for this every time
+
+    Args:
+        app (str): Path to the FastQC executable
+        skip (bool): Only check the executable bit, never launch FastQC
+
+    Returns:
+        None
+    """
+    assert os.access(app, os.X_OK), f"Error: FastQC application at {app} is not executable!"
+    if skip:
+        return
+
+    # Keyed on the resolved path and its mtime so an upgraded or moved install gets probed again
+    app_path = os.path.realpath(app)
+    probe = {"app_path": app_path, "mtime": os.stat(app_path).st_mtime_ns}
+    cache = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "fastqc_pipe" / "fastqc.json"
+    with contextlib.suppress(OSError, ValueError):
+        if json.loads(cache.read_text()) == probe:
+            logging.debug(f"FastQC at {app_path} previously checked, skipping probe")
+            return
+
+    try:
+        subprocess.run([app, "-h"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"FastQC application at {app} failed to run!") from e
+
+    # Not being able to write the cache only costs the probe next time
+    with contextlib.suppress(OSError):
+        cache.parent.mkdir(parents=True, exist_ok=True)
+        cache.write_text(json.dumps(probe))
+
+
+def main(args: argparse.Namespace) -> None:
+    """Main function to run the FastQC pipeline"""
+    # Parse input for merge jobs
+    merge_jobs = parse_input_file(args)
+
+    # Deprioritize ourselves too, so the merge doesn't crowd out other jobs on a shared node
+    if args.polite:
+        os.nice(19)
+
+    # By default FastQC just gets every lane file as-is, there's no need to merge for QC
+    mode = qc_mode(args)
+    lane_files = [file for job in merge_jobs for file in job.files] if mode == "lanes" else []
+    qc_count = len(lane_files) if mode == "lanes" else len(merge_jobs)
+    logging.info(f"Running FastQC in {mode} mode on {qc_count} inputs")
+
+    # Establish number of threads to use for FastQC
+    threads = args.threads
+    if threads == 0:
+        # args.threads=0 means auto-detect and either match threads to jobs or max out available threads
+        threads = min(qc_count, args.max_threads)
+    threads = max(1, threads)
+
+    # FastQC churns through lots of small files, keep them off (possibly networked) final storage
+    staging = tempfile.mkdtemp(
+        prefix="fastqc_", dir=args.tmpdir or ("/dev/shm" if Path("/dev/shm").is_dir() else None)
+    )
+    logging.debug(f"FastQC staging directory: {staging}")
+
+    qc_jobs = []
+    try:
+        if mode == "lanes":
+            # Every file is already on disk, so a single FastQC spreading them over its threads saves a JVM per file
+            failed = fastqc_batch(lane_files, staging, args.outdir, threads, args.polite, args.fastqc_timeout)
+        else:
+            # Merge or stream the lanes, handing each sample to a FastQC worker as soon as it is ready
+            qc_jobs, failed = run_qc_workers(args, merge_jobs, mode, staging, threads)
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+    # Cleanup intermediates/logging, the original lane files are never touched
+    if args.clean:
+        # A merged file may already be gone (removed by hand or never written), that is no reason to fail the run
+        for file in qc_jobs:
+            Path(file).unlink(missing_ok=True)
+
+    # Reports that are missing must not look like a clean run to whatever launched us
+    if failed:
+        logging.error(f"FastQC failed on {failed} inputs, see the errors above.")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    # Parse user arguments and spin up logging
+    args = arg_parser()
+    setup_logging(args.verbose)
+    logging.info("Logging started!")
+
+    # Validate runlist file
+    assert Path(args.file).is_file(), f"Error: Input file ({args.file}) does not exist!"
+
+    # Check for valid thread count
+    logging.debug(f"Cores reported: {args.max_threads}")
+    if args.threads > args.max_threads:
+        logging.warning(f"Too many threads requested! Maximum available on this machine is {args.max_threads}.")
+
+    # Recompression relies on ISA-L or pigz
+    assert not args.recompress or igzip_threaded is not None or shutil.which("pigz"), (
+        "Error: --recompress requires python-isal or pigz!"
+    )
+
+    # Create the desired merge and report directories if needed
+    if args.merge:
+        Path(args.merge).mkdir(parents=True, exist_ok=True)
+    if args.outdir:
+        Path(args.outdir).mkdir(parents=True, exist_ok=True)
+
+    # Check for FastQC install
+    app = shutil.which("fastqc")
+    logging.debug(f"Shutil reports app as {app}")
+    assert app is not None, "Error: FastQC application was not found!"
+    check_fastqc(app, args.skip_fastqc_check)
+
+    # Execute Pipeline
+    main(args)